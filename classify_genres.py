@@ -1,21 +1,27 @@
 import os.path
 
-import re
 import json
+import asyncio
+import hashlib
+from functools import lru_cache
 from logging import Logger
 from pydantic.fields import Field
 
-from ollama import Message, Client
-from typing import TypeVar, Generic, Any, Self
-from pydantic import BaseModel
+import httpx
+from ollama import Message, AsyncClient
+from typing import TypeVar, Generic
+from pydantic import BaseModel, field_validator
 import requests
-from bs4 import BeautifulSoup
-from typing_extensions import override
+from selectolax.lexbor import LexborHTMLParser
+from tqdm.asyncio import tqdm
 
-from persistence import Config, load_model_json
+from persistence import Config, load_model_json, DB, DBLLMCache, db_init
 
 DEBUG = False
 EVERYNOISE_URL = "https://everynoise.com/everynoise1d.html"
+EVERYNOISE_FP = "everynoise.html"
+EVERYNOISE_HEADERS_FP = "everynoise.headers.json"
+OLLAMA_LIMITS = httpx.Limits(max_connections=64, max_keepalive_connections=64)
 
 cfg = load_model_json(Config, "config.json")
 
@@ -69,170 +75,285 @@ class JsonPrompt(BaseModel, Generic[T]):
         self.add_msg(msg)
 
     def build_prompt(self, output_format: JsonOutputFormat) -> list[Message]:
-        system_msg = f"""\
-Do not output any markdown. Do not make any comments. Do not use escape characters.
-
-Output nothing but a JSON in the following format: {json.dumps(output_format.fields())}"""
+        # everything static goes in the system message, so it is an identical prefix
+        # across prompts and the server can reuse its KV cache for it
+        system_msg = f"Output a JSON in the following format: {json.dumps(output_format.fields())}"
+        if self.system_prompt:
+            system_msg = f"{self.system_prompt}\n\n{system_msg}"
         msgs = [Message(
             role="system", content=system_msg
         )] + self.msgs
         return msgs
 
 
+@lru_cache(maxsize=8)
+def ollama_client(host: str, loop: asyncio.AbstractEventLoop) -> AsyncClient:
+    """One client per host and event loop, so every request reuses the same connection pool.
+
+    The pool's connections belong to the loop that opened them, so a new loop needs a new client.
+    """
+    return AsyncClient(host=host, timeout=None, limits=OLLAMA_LIMITS)
+
+
 class LLMConnector:
     """Creates a connection to an LLM server
 
     Parameters:
         log (_Logger_): the logger used to log
-        cli (_Client_): the client used to connect to the LLM server
+        host (_str_): the LLM server to connect to
         model (_str_): the model to use for the LLM server
+        db (_DB | None_): database holding the response cache, no caching if None
+        keep_alive (_str_): how long the server keeps the model (and its KV cache) loaded between requests
     """
     log: Logger
-    cli: Client
+    host: str
     model: str
+    db: DB | None
+    keep_alive: str
 
-    def __init__(self, log: Logger, host: str, model: str):
+    def __init__(self, log: Logger, host: str, model: str, db: DB | None = None, keep_alive: str = "30m"):
         self.log = log
-        self.cli = Client(host=host)
+        self.host = host
         self.model = model
+        self.db = db
+        self.keep_alive = keep_alive
 
-    def json_prompt(self, prompt: JsonPrompt[T], max_tries: int = 20) -> T | None:
+    @property
+    def cli(self) -> AsyncClient:
+        """The client used to connect to the LLM server from the running event loop."""
+        return ollama_client(self.host, asyncio.get_running_loop())
+
+    def cache_key(self, prompt: JsonPrompt[T]) -> str:
+        """Hash everything that determines the response to a prompt."""
+        msgs = prompt.build_prompt(prompt.output_format)
+        key = json.dumps({
+            "model": self.model,
+            "system_prompt": prompt.system_prompt,
+            "msgs": [{"role": m["role"], "content": m["content"]} for m in msgs],
+            "fields": prompt.output_format.fields(),
+        }, sort_keys=True)
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    async def json_prompt(self, prompt: JsonPrompt[T]) -> T | None:
         """Generate a chat response from a json prompt.
 
+        The output format's JSON schema is passed to the server, which constrains generation to
+        match it. Responses are cached by prompt, so repeated prompts never hit the LLM server.
+
         Args:
             prompt (JsonPrompt): The json prompt to send to the LLM server.
 
         Returns:
             T: same as return_type, but with the data from the LLM server.
         """
-        if max_tries == 0:
-            return None
+        if self.db is None:
+            return await self._json_prompt(prompt)
+
+        key = self.cache_key(prompt)
+        cached = DBLLMCache.get(self.db, key)
+        if cached is not None:
+            try:
+                return prompt.output_format.model_validate_json(cached.resp)
+            except ValueError as e:
+                self.log.error(f"Ignoring invalid cached response: {e}. Resp: {cached.resp}")
+
+        output_format = await self._json_prompt(prompt)
+        if output_format is not None:
+            DBLLMCache.insert(self.db, key, output_format.model_dump_json())
+        return output_format
 
+    async def _json_prompt(self, prompt: JsonPrompt[T]) -> T | None:
         msgs = prompt.build_prompt(prompt.output_format)
         self.log.debug(f"Making json prompt request with {len(prompt.msgs)} messages.")
-        resp = self.cli.chat(model=self.model, messages=msgs).message.content
+        resp = (await self.cli.chat(
+            model=self.model,
+            messages=msgs,
+            format=prompt.output_format.model_json_schema(),
+            keep_alive=self.keep_alive
+        )).message.content
         prompt.add_msg(Message(role="assistant", content=resp))
 
-        # Parse the response and return the output format
         try:
-            # replace \& with & recursively until no more are found (mainly because of R&B)
-            while "\\&" in resp:
-                resp = resp.replace("\\&", "&")
-            # basic regex to extract info between { }
-            # elimates markdown format errors, the most common type of format error
-            resp = re.search("{[^}]*}", resp)
-            if resp is None:
-                raise ValueError("No JSON found in response.")
-            resp = resp.group(0)
-            output_format = prompt.output_format.model_validate_json(resp)
+            return prompt.output_format.model_validate_json(resp)
         except ValueError as e:
-            self.log.error(f"Error parsing response: {e}. Retrying. Resp: {resp}")
-            prompt.add_msg(Message(
-                role="user", content=f"That did not work. Here is the error I get: `{e}`. Please try again."
-            ))
-            return self.json_prompt(prompt, max_tries - 1)
-
-        return output_format
+            self.log.error(f"Error parsing response: {e}. Resp: {resp}")
+            return None
 
 
 def fetch_everynoise():
     def make_request():
-        response = requests.get(EVERYNOISE_URL)
+        # conditional request, the page is only downloaded again if it changed
+        headers = {}
+        if os.path.exists(EVERYNOISE_FP) and os.path.exists(EVERYNOISE_HEADERS_FP):
+            with open(EVERYNOISE_HEADERS_FP, "r") as f:
+                headers = json.load(f)
+        response = requests.get(EVERYNOISE_URL, headers=headers)
+        if response.status_code == 304:
+            with open(EVERYNOISE_FP, "r") as f:
+                return f.read()
+        response.raise_for_status()
+
+        with open(EVERYNOISE_FP, "w") as f:
+            f.write(response.text)
+        headers = {}
+        if "ETag" in response.headers:
+            headers["If-None-Match"] = response.headers["ETag"]
+        if "Last-Modified" in response.headers:
+            headers["If-Modified-Since"] = response.headers["Last-Modified"]
+        with open(EVERYNOISE_HEADERS_FP, "w") as f:
+            json.dump(headers, f)
         return response.text
 
-    if not DEBUG:
-        if os.path.exists("everynoise.html"):
-            os.remove("everynoise.html")
-        data = make_request()
-    else:
-        if not os.path.exists("everynoise.html"):
-            data = make_request()
-            with open("everynoise.html", "w") as f:
-                f.write(data)
-        else:
-            with open("everynoise.html", "r") as f:
-                data = f.read()
-
-    return data
+    if DEBUG and os.path.exists(EVERYNOISE_FP):
+        with open(EVERYNOISE_FP, "r") as f:
+            return f.read()
+    return make_request()
 
 
 def get_all_genres(data: str) -> list[str]:
-    soup = BeautifulSoup(data, "lxml")
-    genres = soup.select("table > tr > td:nth-of-type(3) > a")
-    return [genre.text for genre in genres]
+    # lexbor follows the HTML5 spec and inserts the implicit <tbody>, so no `table > tr`
+    genres = LexborHTMLParser(data).css("table tr > td:nth-of-type(3) > a")
+    return [genre.text() for genre in genres]
 
 
 class ClassifyGenreOutput(JsonOutputFormat):
+    genre: str
     reason: str
-    fundamental_genre: str
+    fundamental_genre: str = Field(json_schema_extra={"enum": cfg.fundamental_genres})
 
     @staticmethod
+    @lru_cache
     def fields():
         return {
+            "genre": "str",
             "reason": "str",
             "fundamental_genre": "str"
         }
 
-    @override
-    def model_validate_json(
-            cls,
-            json_data: str | bytes | bytearray,
-            *,
-            strict: bool | None = None,
-            context: Any | None = None,
-    ) -> Self:
-        s: "ClassifyGenreOutput" = super().model_validate_json(json_data, strict=strict, context=context)
-        s.fundamental_genre = s.fundamental_genre.lower()
-        if s.fundamental_genre not in cfg.fundamental_genres:
-            raise ValueError(f"Invalid fundamental genre: {s.fundamental_genre}. Choose from {cfg.fundamental_genres}")
-        return s
-
-
-def classify_genres(all_genres: list[str], fundamental_genres: list[str], llm: LLMConnector) -> dict[str, str]:
-    classifed = {}
-    for i, genre in enumerate(all_genres):
-        prompt = JsonPrompt(
-            output_format=ClassifyGenreOutput.model_construct(),
-            system_prompt="""\
-""".format(
-                fundamentals=json.dumps(fundamental_genres, indent=2)
-            ),
-            msgs=[Message(
-                role="user",
-                content="""\
+    @field_validator("fundamental_genre")
+    @classmethod
+    def validate_fundamental_genre(cls, fundamental_genre: str) -> str:
+        fundamental_genre = fundamental_genre.lower()
+        if fundamental_genre not in cfg.fundamental_genres:
+            raise ValueError(f"Invalid fundamental genre: {fundamental_genre}. Choose from {cfg.fundamental_genres}")
+        return fundamental_genre
+
+
+class ClassifyGenreBatchOutput(JsonOutputFormat):
+    classifications: list[ClassifyGenreOutput]
+
+    @staticmethod
+    @lru_cache
+    def fields():
+        return {
+            "classifications": [ClassifyGenreOutput.fields()]
+        }
+
+
+async def classify_genres(
+        all_genres: list[str],
+        fundamental_genres: list[str],
+        llm: LLMConnector,
+        num_parallel: int = 8,
+        batch_size: int = 20,
+        progress_fp: str | None = None
+) -> dict[str, str]:
+    """Classify every sub-genre concurrently.
+
+    If `progress_fp` is given, every finished classification is appended to it as a
+    JSON line, so an interrupted run doesn't lose its work (see `load_progress`).
+
+    Sub-genres are sent `batch_size` at a time so the fundamentals list is only
+    processed once per batch. Keep it small enough that the output stays short,
+    output tokens are generated one after another.
+
+    At most `num_parallel` requests are in flight at once, this should match
+    `OLLAMA_NUM_PARALLEL` on the server so requests don't just queue up there.
+    """
+    sem = asyncio.Semaphore(num_parallel)
+    system_prompt = """\
 You are tasked with classifying sub-genres of music into their respective fundamental genres.
 
 Here is a list of the fundamental genres:
 {fundamentals}
 
-You must first give your reasoning for why the sub-genre belongs to the fundamental genre.
+For each sub-genre, you must first give your reasoning for why the sub-genre belongs to the fundamental genre.
 
-Then, you must output the exact fundamental genre that the sub-genre belongs to. Do not change case or spelling.
+Then, you must output the exact fundamental genre that the sub-genre belongs to. Do not change case or spelling.""".format(
+        fundamentals=json.dumps(fundamental_genres, indent=2)
+    )
 
-Classify the sub-genre: \"{genre}\"""".format(
-                    fundamentals=json.dumps(fundamental_genres, indent=2),
-                    genre=genre
-                )
+    async def classify_batch(genres: list[str]) -> dict[str, str | None]:
+        prompt = JsonPrompt(
+            output_format=ClassifyGenreBatchOutput.model_construct(),
+            system_prompt=system_prompt,
+            msgs=[Message(
+                role="user",
+                content=f"Classify each of the following sub-genres: {json.dumps(genres)}"
             )]
         )
-        output = llm.json_prompt(prompt)
-        if output is None:
-            print(f" > ({i + 1}/{len(all_genres)}) {genre} -> ERROR")
-            classifed[genre] = None
-        else:
-            print(f" > ({i + 1}/{len(all_genres)}) {genre} -> {output.fundamental_genre} ({output.reason})")
-            classifed[genre] = output.fundamental_genre
-    return classifed
-
-
-def main(cfg: Config):
+        async with sem:
+            output = await llm.json_prompt(prompt)
+
+        classified = {}
+        if output is not None:
+            for c in output.classifications:
+                if c.genre in genres:
+                    classified[c.genre] = c.fundamental_genre
+                    tqdm.write(f" > {c.genre} -> {c.fundamental_genre} ({c.reason})")
+        for genre in genres:
+            if genre not in classified:
+                tqdm.write(f" > {genre} -> ERROR")
+                classified[genre] = None
+        if progress_fp is not None:
+            with open(progress_fp, "a") as f:
+                for genre, fundamental in classified.items():
+                    if fundamental is not None:
+                        f.write(json.dumps({genre: fundamental}) + "\n")
+        return classified
+
+    batches = [all_genres[i:i + batch_size] for i in range(0, len(all_genres), batch_size)]
+    results = await tqdm.gather(
+        *[classify_batch(batch) for batch in batches],
+        desc="Classifying genres"
+    )
+    return {genre: fundamental for r in results for genre, fundamental in r.items()}
+
+
+def load_progress(progress_fp: str) -> dict[str, str]:
+    """Read the classifications written by an interrupted `classify_genres` run."""
+    classified = {}
+    if os.path.exists(progress_fp):
+        with open(progress_fp, "r") as f:
+            for line in f:
+                if line.strip():
+                    classified.update(json.loads(line))
+    return classified
+
+
+async def main(cfg: Config):
     data = fetch_everynoise()
     genres = get_all_genres(data)
-    llm = LLMConnector(Logger("llm"), cfg.ollama_host, cfg.ollama_model)
-    classified = classify_genres(genres, cfg.fundamental_genres, llm)
+
+    progress_fp = f"{cfg.classified_genres_fp}.partial.jsonl"
+    classified = {}
+    if os.path.exists(cfg.classified_genres_fp):
+        with open(cfg.classified_genres_fp, "r") as f:
+            classified = json.load(f)
+    classified.update(load_progress(progress_fp))
+    todo = [genre for genre in genres if classified.get(genre) is None]
+    print(f"Already classified: {len(genres) - len(todo)}, to classify: {len(todo)}")
+
+    db = db_init(cfg.db_fp)
+    llm = LLMConnector(Logger("llm"), cfg.ollama_host, cfg.ollama_model, db)
+    classified |= await classify_genres(
+        todo, cfg.fundamental_genres, llm, cfg.ollama_num_parallel, cfg.ollama_batch_size, progress_fp
+    )
     with open(cfg.classified_genres_fp, "w") as f:
         json.dump(classified, f, indent=2)
+    if os.path.exists(progress_fp):
+        os.remove(progress_fp)
 
 
 if __name__ == "__main__":
-    main(cfg)
+    asyncio.run(main(cfg))
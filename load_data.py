@@ -1,46 +1,74 @@
+import asyncio
+
+import aiohttp
 from dotenv import load_dotenv
-import spotipy
 from spotipy import SpotifyClientCredentials
-from tqdm import tqdm
+from tqdm.asyncio import tqdm
+
+from persistence import blake3_dir, DIR_HASH_ALGO, db_init, DB, DBInfo, DBPlay, DBSong, SpotifySongSpan, db_clear_user_data, \
+    DBSpotipySong, DBSongArtist, DBSpotipyArtist, DBSpotipyAlbum, Config, load_model_json
 
-from persistence import md5_dir, db_init, DB, DBInfo, DBPlay, DBSong, SpotifySongSpan, db_clear_user_data, \
-    DBSpotipySong, DBSpotipyArtist, DBSpotipyAlbum, Config, load_model_json
+SPOTIFY_API_URL = "https://api.spotify.com/v1"
+MAX_CONCURRENT_REQUESTS = 10
+REQUEST_TIMEOUT = 5
+MAX_RETRIES = 3
+BACKOFF_FACTOR = 0.3
+RETRY_STATUSES = (500, 502, 503, 504)
 
 
 def sync_spotify_data_to_db(db: DB, data_dir: str):
-    curr_hash = md5_dir(data_dir)
+    curr_hash = blake3_dir(data_dir)
     db_hash = DBInfo.get(db)
-    if db_hash is not None and curr_hash == db_hash.last_dir_hash:
+    if db_hash is not None and db_hash.hash_algo == DIR_HASH_ALGO and curr_hash == db_hash.last_dir_hash:
         return
 
-    db_clear_user_data(db)
-
-    spans = SpotifySongSpan.load_history(data_dir)
-    filtered_spans = [s for s in spans if s.valid_span()]
+    total_spans = 0
+    filtered_spans = []
+    for s in SpotifySongSpan.load_history(data_dir):
+        total_spans += 1
+        if s.valid_span():
+            filtered_spans.append(s)
     print(
-        f"Total spans: {len(spans)}, valid spans: {len(filtered_spans)} (filtered out {len(spans) - len(filtered_spans)})")
+        f"Total spans: {total_spans}, valid spans: {len(filtered_spans)} (filtered out {total_spans - len(filtered_spans)})")
 
-    songs = {s.spotify_track_uri: DBSong.from_spotify_song_span(s) for s in filtered_spans}
-    plays = [DBPlay.from_spotify_song_span(s) for s in filtered_spans]
+    # one transaction for the whole rewrite, a single commit instead of one per insert
+    with db:
+        db_clear_user_data(db)
 
-    DBSong.insert_many(db, list(songs.values()))
-    DBPlay.insert_many(db, plays)
-    DBInfo.insert(db, curr_hash)
+        # songs played more than once are deduplicated by the primary key conflict
+        DBSong.insert_many(db, (DBSong.from_spotify_song_span(s) for s in filtered_spans))
+        DBPlay.insert_many(db, (DBPlay.from_spotify_song_span(s) for s in filtered_spans))
+        DBInfo.insert(db, curr_hash, DIR_HASH_ALGO)
 
 
-def sync_song_artist_album_data(db: DB):
+async def sync_song_artist_album_data(db: DB):
     print("Syncing song, artist, and album data")
-    sp = spotipy.Spotify(
-        auth_manager=SpotifyClientCredentials()
-    )
-
-    def batch_iter(iterable, batch_size, desc: str = None):
-        for i in tqdm(
-                range(0, len(iterable), batch_size),
-                desc=desc
-        ):
+    token = SpotifyClientCredentials().get_access_token(as_dict=False)
+    sem = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+    def batch_iter(iterable, batch_size):
+        for i in range(0, len(iterable), batch_size):
             yield iterable[i:i + batch_size]
 
+    async def fetch_batch(session: aiohttp.ClientSession, endpoint: str, ids: list[str]) -> dict:
+        # same transport behaviour as spotipy: retry server errors and dropped connections with backoff
+        async with sem:
+            tries = 0
+            while True:
+                try:
+                    async with session.get(f"{SPOTIFY_API_URL}/{endpoint}", params={"ids": ",".join(ids)}) as resp:
+                        if resp.status == 429:
+                            await asyncio.sleep(int(resp.headers.get("Retry-After", 1)))
+                            continue
+                        resp.raise_for_status()
+                        return await resp.json()
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    retryable = not isinstance(e, aiohttp.ClientResponseError) or e.status in RETRY_STATUSES
+                    if not retryable or tries >= MAX_RETRIES:
+                        raise
+                    await asyncio.sleep(BACKOFF_FACTOR * 2 ** tries)
+                    tries += 1
+
     def make_spotipy_albums_data(d: dict) -> DBSpotipyAlbum:
         album_batch = [
             DBSpotipyAlbum(
@@ -53,11 +81,11 @@ def sync_song_artist_album_data(db: DB):
         ]
         DBSpotipyAlbum.insert_many(db, album_batch)
 
-    def fetch_spotipy_songs_data(ids: list[str]) -> DBSpotipySong:
+    async def fetch_spotipy_songs_data(session: aiohttp.ClientSession, ids: list[str]) -> DBSpotipySong:
         BATCH_SIZE = 50
-        for batch in batch_iter(ids, BATCH_SIZE, desc="Fetching Spotify song data"):
-            data = sp.tracks(batch)
-            make_spotipy_albums_data(data)
+
+        async def fetch_songs_batch(batch: list[str]):
+            data = await fetch_batch(session, "tracks", batch)
             song_batch = [
                 DBSpotipySong(
                     track_id=track['id'],
@@ -69,12 +97,27 @@ def sync_song_artist_album_data(db: DB):
                 )
                 for track in data['tracks']
             ]
-            DBSpotipySong.insert_many(db, song_batch)
-
-    def fetch_spotipy_artists_data(ids: list[str]) -> DBSpotipyArtist:
+            song_artist_batch = [
+                DBSongArtist(track_id=track['id'], artist_id=a['id'])
+                for track in data['tracks']
+                for a in track['artists']
+            ]
+            # commit each batch, so an interrupted sync resumes from the new id diff
+            with db:
+                make_spotipy_albums_data(data)
+                DBSpotipySong.insert_many(db, song_batch)
+                DBSongArtist.insert_many(db, song_artist_batch)
+
+        await tqdm.gather(
+            *[fetch_songs_batch(batch) for batch in batch_iter(ids, BATCH_SIZE)],
+            desc="Fetching Spotify song data"
+        )
+
+    async def fetch_spotipy_artists_data(session: aiohttp.ClientSession, ids: list[str]) -> DBSpotipyArtist:
         BATCH_SIZE = 50
-        for batch in batch_iter(ids, BATCH_SIZE, desc="Fetching Spotify artist data"):
-            data = sp.artists(batch)
+
+        async def fetch_artists_batch(batch: list[str]):
+            data = await fetch_batch(session, "artists", batch)
             artist_batch = [
                 DBSpotipyArtist(
                     artist_id=artist['id'],
@@ -85,34 +128,34 @@ def sync_song_artist_album_data(db: DB):
                 )
                 for artist in data['artists']
             ]
-            DBSpotipyArtist.insert_many(db, artist_batch)
-
-    unq_song_ids = DBSong.get_all_song_ids(db)
-    print(f"> Unique songs: {len(unq_song_ids)}")
-    ex_song_ids = DBSpotipySong.get_all_song_ids(db)
-    print(f"> Existing songs: {len(ex_song_ids)}")
+            with db:
+                DBSpotipyArtist.insert_many(db, artist_batch)
 
-    new_song_ids = list(set(unq_song_ids) - set(ex_song_ids))
-    print(f"> New songs: {len(new_song_ids)}")
-    fetch_spotipy_songs_data(new_song_ids)
+        await tqdm.gather(
+            *[fetch_artists_batch(batch) for batch in batch_iter(ids, BATCH_SIZE)],
+            desc="Fetching Spotify artist data"
+        )
 
-    artists = DBSpotipySong.get_all_artist_ids(db)
-    print(f"> Unique artists: {len(artists)}")
-    ex_artist_ids = DBSpotipyArtist.get_all_artist_ids(db)
-    print(f"> Existing artists: {len(ex_artist_ids)}")
+    async with aiohttp.ClientSession(
+            headers={"Authorization": f"Bearer {token}"},
+            timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
+    ) as session:
+        new_song_ids = DBSong.get_new_song_ids(db)
+        print(f"> New songs: {len(new_song_ids)}")
+        await fetch_spotipy_songs_data(session, new_song_ids)
 
-    new_artist_ids = list(set(artists) - set(ex_artist_ids))
-    print(f"> New artists: {len(new_artist_ids)}")
-    fetch_spotipy_artists_data(new_artist_ids)
+        new_artist_ids = DBSpotipyArtist.get_new_artist_ids(db)
+        print(f"> New artists: {len(new_artist_ids)}")
+        await fetch_spotipy_artists_data(session, new_artist_ids)
 
 
-def main(cfg: Config):
+async def main(cfg: Config):
     db = db_init(cfg.db_fp)
     sync_spotify_data_to_db(db, cfg.spotify_data_dir)
-    sync_song_artist_album_data(db)
+    await sync_song_artist_album_data(db)
 
 
 if __name__ == "__main__":
     load_dotenv()
     cfg = load_model_json(Config, "config.json")
-    main(cfg)
+    asyncio.run(main(cfg))
@@ -1,23 +1,61 @@
 import os
-import json
 from typing import Optional
-from pydantic import BaseModel
+import orjson
+from pydantic import BaseModel, TypeAdapter
 import sqlite3
 import datetime as dt
 from sqlite3 import Error
 from dataclasses import dataclass
 from tqdm import tqdm
-from typing import Type, TypeVar
+from typing import Type, TypeVar, Iterable, Iterator
+from itertools import islice
+from operator import attrgetter
+import heapq
 
-import hashlib
-from _hashlib import HASH as Hash
+import blake3
 from pathlib import Path
 from typing import Union
+from concurrent.futures import ThreadPoolExecutor
 
 DB = sqlite3.Connection
 
+DIR_HASH_ALGO = "blake3"
+
 T = TypeVar('T')
 
+INSERT_CHUNK_SIZE = 1000
+
+# compiled once per connection and reused from sqlite3's statement cache
+# spans are inserted in time order, so the latest metadata of a song wins
+_INSERT_SONG_SQL = (
+    "INSERT INTO songs (track_id, track_name, album_artist_name, album_name) VALUES (?, ?, ?, ?)"
+    "ON CONFLICT(track_id) DO UPDATE SET track_name = excluded.track_name, "
+    "album_artist_name = excluded.album_artist_name, album_name = excluded.album_name"
+)
+_INSERT_PLAY_SQL = "INSERT INTO plays (ts, track_id, ms_played) VALUES (?, ?, ?)"
+_INSERT_SPOTIPY_SONG_SQL = (
+    "INSERT INTO spotipy_songs (track_id, track_name, explicit, duration_ms, album_id, artist_ids_csv) VALUES (?, ?, ?, ?, ?, ?)"
+    "ON CONFLICT(track_id) DO NOTHING"
+)
+_INSERT_SONG_ARTIST_SQL = (
+    "INSERT INTO song_artists (track_id, artist_id) VALUES (?, ?)"
+    "ON CONFLICT(track_id, artist_id) DO NOTHING"
+)
+_INSERT_SPOTIPY_ALBUM_SQL = (
+    "INSERT INTO spotipy_albums (album_id, album_name, release_date, total_tracks) VALUES (?, ?, ?, ?)"
+    "ON CONFLICT(album_id) DO NOTHING"
+)
+_INSERT_SPOTIPY_ARTIST_SQL = (
+    "INSERT INTO spotipy_artists (artist_id, artist_name, genres_csv, popularity, followers) VALUES (?, ?, ?, ?, ?)"
+    "ON CONFLICT(artist_id) DO NOTHING"
+)
+
+
+def chunked(iterable: Iterable[T], size: int = INSERT_CHUNK_SIZE) -> Iterator[list[T]]:
+    it = iter(iterable)
+    while chunk := list(islice(it, size)):
+        yield chunk
+
 
 def load_model_json(model: Type[T], fp: str) -> T:
     with open(fp, 'r') as f:
@@ -29,6 +67,8 @@ class Config(BaseModel):
     db_fp: str
     ollama_model: str
     ollama_host: str
+    ollama_num_parallel: int = 8
+    ollama_batch_size: int = 20
     classified_genres_fp: str
     fundamental_genres: list[str]
 
@@ -54,18 +94,30 @@ class SpotifySongSpan(BaseModel):
     incognito_mode: bool
 
     @staticmethod
-    def load_history(dir: str) -> list["SpotifySongSpan"]:
-        files = [f for f in os.listdir(dir) if f.endswith(".json")]
-        songs = []
-        for f in tqdm(
-                files,
+    def load_file(fp: str) -> list["SpotifySongSpan"]:
+        """Load the spans of a single history file, sorted by timestamp."""
+        with open(fp, 'rb') as file:
+            data = orjson.loads(file.read())
+        spans = _SPAN_ADAPTER.validate_python(data)
+        spans.sort(key=attrgetter("ts"))
+        return spans
+
+    @staticmethod
+    def load_history(dir: str) -> Iterator["SpotifySongSpan"]:
+        """Load all spans, ordered by timestamp.
+
+        Files are loaded on a thread pool. Each file is already (almost) in order, so
+        sorting them individually is cheap and they are then lazily merged instead of
+        sorting everything at once.
+        """
+        files = [f"{dir}/{f}" for f in os.listdir(dir) if f.endswith(".json")]
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+            per_file = list(tqdm(
+                ex.map(SpotifySongSpan.load_file, files),
+                total=len(files),
                 desc="Loading Spotify song spans",
-        ):
-            with open(f"{dir}/{f}", 'r') as file:
-                data = json.load(file)
-                songs.extend([SpotifySongSpan(**d) for d in data])
-        songs.sort(key=lambda x: x.ts)
-        return songs
+            ))
+        return heapq.merge(*per_file, key=attrgetter("ts"))
 
     def valid_span(self) -> bool:
         return self.spotify_track_uri is not None \
@@ -76,6 +128,9 @@ class SpotifySongSpan(BaseModel):
             and self.ms_played is not None
 
 
+_SPAN_ADAPTER = TypeAdapter(list[SpotifySongSpan])
+
+
 @dataclass
 class DBSong:
     track_id: str
@@ -94,11 +149,11 @@ class DBSong:
         )
 
     @staticmethod
-    def insert_many(db: DB, songs: list["DBSong"]) -> None:
-        c = db.cursor()
-        c.executemany("INSERT INTO songs (track_id, track_name, album_artist_name, album_name) VALUES (?, ?, ?, ?)",
-                      [(s.track_id, s.track_name, s.album_artist_name, s.album_name) for s in songs])
-        db.commit()
+    def insert_many(db: DB, songs: Iterable["DBSong"]) -> None:
+        for chunk in chunked(songs):
+            db.executemany(
+                _INSERT_SONG_SQL,
+                [(s.track_id, s.track_name, s.album_artist_name, s.album_name) for s in chunk])
 
     @staticmethod
     def get_all_song_ids(db: DB) -> list[str]:
@@ -107,6 +162,14 @@ class DBSong:
         rows = c.fetchall()
         return [row[0] for row in rows]
 
+    @staticmethod
+    def get_new_song_ids(db: DB) -> list[str]:
+        """Song ids that have no Spotify API data yet."""
+        c = db.cursor()
+        c.execute("SELECT s.track_id FROM songs s LEFT JOIN spotipy_songs p USING(track_id) WHERE p.track_id IS NULL")
+        rows = c.fetchall()
+        return [row[0] for row in rows]
+
     @staticmethod
     def get_all(db: DB) -> list["DBSong"]:
         c = db.cursor()
@@ -133,11 +196,11 @@ class DBPlay:
         )
 
     @staticmethod
-    def insert_many(db: DB, plays: list["DBPlay"]) -> None:
-        c = db.cursor()
-        c.executemany("INSERT INTO plays (ts, track_id, ms_played) VALUES (?, ?, ?)",
-                      [(p.ts, p.track_id, p.ms_played) for p in plays])
-        db.commit()
+    def insert_many(db: DB, plays: Iterable["DBPlay"]) -> None:
+        for chunk in chunked(plays):
+            db.executemany(
+                _INSERT_PLAY_SQL,
+                [(p.ts, p.track_id, p.ms_played) for p in chunk])
 
     @staticmethod
     def get_all(db: DB) -> list["DBPlay"]:
@@ -151,22 +214,44 @@ class DBPlay:
 class DBInfo:
     hash_id: int
     last_dir_hash: str
+    hash_algo: Optional[str]
 
     @staticmethod
     def get(db: DB) -> Optional["DBInfo"]:
         c = db.cursor()
-        c.execute("SELECT * FROM info ORDER BY hash_id DESC LIMIT 1")
+        c.execute("SELECT hash_id, last_dir_hash, hash_algo FROM info ORDER BY hash_id DESC LIMIT 1")
+        row = c.fetchone()
+        if row is None:
+            return None
+        return DBInfo(row[0], row[1], row[2])
+
+    @staticmethod
+    def insert(db: DB, dir_hash: str, hash_algo: str) -> "DBInfo":
+        c = db.cursor()
+        c.execute("INSERT INTO info (last_dir_hash, hash_algo) VALUES (?, ?)", (dir_hash, hash_algo))
+        return DBInfo(c.lastrowid, dir_hash, hash_algo)
+
+
+@dataclass
+class DBLLMCache:
+    key: str
+    resp: str
+
+    @staticmethod
+    def get(db: DB, key: str) -> Optional["DBLLMCache"]:
+        c = db.cursor()
+        c.execute("SELECT key, resp FROM llm_cache WHERE key = ?", (key,))
         row = c.fetchone()
         if row is None:
             return None
-        return DBInfo(row[0], row[1])
+        return DBLLMCache(row[0], row[1])
 
     @staticmethod
-    def insert(db: DB, dir_hash: str) -> "DBInfo":
+    def insert(db: DB, key: str, resp: str) -> None:
         c = db.cursor()
-        c.execute("INSERT INTO info (last_dir_hash) VALUES (?)", (dir_hash,))
+        c.execute("INSERT INTO llm_cache (key, resp) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET resp = excluded.resp",
+                  (key, resp))
         db.commit()
-        return DBInfo(c.lastrowid, dir_hash)
 
 
 @dataclass
@@ -188,19 +273,16 @@ class DBSpotipySong:
     @staticmethod
     def get_all_artist_ids(db: DB) -> list[str]:
         c = db.cursor()
-        c.execute("SELECT artist_ids_csv FROM spotipy_songs")
+        c.execute("SELECT DISTINCT artist_id FROM song_artists")
         rows = c.fetchall()
-        artist_csvs = [row[0] for row in rows]
-        return list(set([artist_id for csv in artist_csvs for artist_id in csv.split(",")]))
+        return [row[0] for row in rows]
 
     @staticmethod
-    def insert_many(db: DB, songs: list["DBSpotipySong"]) -> None:
-        c = db.cursor()
-        c.executemany(
-            "INSERT INTO spotipy_songs (track_id, track_name, explicit, duration_ms, album_id, artist_ids_csv) VALUES (?, ?, ?, ?, ?, ?)"
-            "ON CONFLICT(track_id) DO NOTHING",
-            [(s.track_id, s.track_name, s.explicit, s.duration_ms, s.album_id, s.artist_ids_csv) for s in songs])
-        db.commit()
+    def insert_many(db: DB, songs: Iterable["DBSpotipySong"]) -> None:
+        for chunk in chunked(songs):
+            db.executemany(
+                _INSERT_SPOTIPY_SONG_SQL,
+                [(s.track_id, s.track_name, s.explicit, s.duration_ms, s.album_id, s.artist_ids_csv) for s in chunk])
 
     @staticmethod
     def get_all(db: DB) -> list["DBSpotipySong"]:
@@ -210,6 +292,19 @@ class DBSpotipySong:
         return [DBSpotipySong(row[0], row[1], row[2], row[3], row[4], row[5]) for row in rows]
 
 
+@dataclass
+class DBSongArtist:
+    track_id: str
+    artist_id: str
+
+    @staticmethod
+    def insert_many(db: DB, song_artists: Iterable["DBSongArtist"]) -> None:
+        for chunk in chunked(song_artists):
+            db.executemany(
+                _INSERT_SONG_ARTIST_SQL,
+                [(sa.track_id, sa.artist_id) for sa in chunk])
+
+
 @dataclass
 class DBSpotipyAlbum:
     album_id: str
@@ -218,13 +313,11 @@ class DBSpotipyAlbum:
     total_tracks: int
 
     @staticmethod
-    def insert_many(db: DB, albums: list["DBSpotipyAlbum"]) -> None:
-        c = db.cursor()
-        c.executemany(
-            "INSERT INTO spotipy_albums (album_id, album_name, release_date, total_tracks) VALUES (?, ?, ?, ?)"
-            "ON CONFLICT(album_id) DO NOTHING",
-            [(a.album_id, a.album_name, a.release_date, a.total_tracks) for a in albums])
-        db.commit()
+    def insert_many(db: DB, albums: Iterable["DBSpotipyAlbum"]) -> None:
+        for chunk in chunked(albums):
+            db.executemany(
+                _INSERT_SPOTIPY_ALBUM_SQL,
+                [(a.album_id, a.album_name, a.release_date, a.total_tracks) for a in chunk])
 
     @staticmethod
     def get_all(db: DB) -> list["DBSpotipyAlbum"]:
@@ -250,13 +343,19 @@ class DBSpotipyArtist:
         return [row[0] for row in rows]
 
     @staticmethod
-    def insert_many(db: DB, artists: list["DBSpotipyArtist"]) -> None:
+    def get_new_artist_ids(db: DB) -> list[str]:
+        """Artist ids referenced by songs that have no Spotify API data yet."""
         c = db.cursor()
-        c.executemany(
-            "INSERT INTO spotipy_artists (artist_id, artist_name, genres_csv, popularity, followers) VALUES (?, ?, ?, ?, ?)"
-            "ON CONFLICT(artist_id) DO NOTHING",
-            [(a.artist_id, a.artist_name, a.genres_csv, a.popularity, a.followers) for a in artists])
-        db.commit()
+        c.execute("SELECT artist_id FROM song_artists EXCEPT SELECT artist_id FROM spotipy_artists")
+        rows = c.fetchall()
+        return [row[0] for row in rows]
+
+    @staticmethod
+    def insert_many(db: DB, artists: Iterable["DBSpotipyArtist"]) -> None:
+        for chunk in chunked(artists):
+            db.executemany(
+                _INSERT_SPOTIPY_ARTIST_SQL,
+                [(a.artist_id, a.artist_name, a.genres_csv, a.popularity, a.followers) for a in chunk])
 
     @staticmethod
     def get_all(db: DB) -> list["DBSpotipyArtist"]:
@@ -285,8 +384,12 @@ def db_init(db_file: str) -> DB:
     db_execute(conn, """
     CREATE TABLE IF NOT EXISTS info (
         hash_id INTEGER PRIMARY KEY AUTOINCREMENT,
-        last_dir_hash TEXT
+        last_dir_hash TEXT,
+        hash_algo TEXT
     )""")
+    # databases created before hash_algo existed, their hashes are md5 and will be redone
+    if "hash_algo" not in [row[1] for row in conn.execute("PRAGMA table_info(info)")]:
+        db_execute(conn, "ALTER TABLE info ADD COLUMN hash_algo TEXT")
     db_execute(conn, """
     CREATE TABLE IF NOT EXISTS spotipy_songs (
         track_id TEXT NOT NULL PRIMARY KEY,
@@ -297,6 +400,21 @@ def db_init(db_file: str) -> DB:
         artist_ids_csv TEXT NOT NULL
     )""")
     db_execute(conn, """
+    CREATE TABLE IF NOT EXISTS song_artists (
+        track_id TEXT NOT NULL,
+        artist_id TEXT NOT NULL,
+        PRIMARY KEY (track_id, artist_id)
+    )""")
+    db_execute(conn, "CREATE INDEX IF NOT EXISTS song_artists_artist_id ON song_artists (artist_id)")
+    # databases created before song_artists existed, fill it from artist_ids_csv (artist ids are base62,
+    # so the csv can be turned into a JSON array and exploded with json_each)
+    if conn.execute("SELECT 1 FROM song_artists LIMIT 1").fetchone() is None:
+        with conn:
+            db_execute(conn, """
+            INSERT INTO song_artists (track_id, artist_id)
+            SELECT DISTINCT s.track_id, a.value
+            FROM spotipy_songs s, json_each('["' || replace(s.artist_ids_csv, ',', '","') || '"]') a""")
+    db_execute(conn, """
     CREATE TABLE IF NOT EXISTS spotipy_albums (
         album_id TEXT NOT NULL PRIMARY KEY,
         album_name TEXT NOT NULL,
@@ -311,6 +429,11 @@ def db_init(db_file: str) -> DB:
         popularity INTEGER NOT NULL,
         followers INTEGER NOT NULL
     )""")
+    db_execute(conn, """
+    CREATE TABLE IF NOT EXISTS llm_cache (
+        key TEXT NOT NULL PRIMARY KEY,
+        resp TEXT NOT NULL
+    )""")
     return conn
 
 
@@ -318,13 +441,16 @@ def db_clear_user_data(db: DB) -> None:
     c = db.cursor()
     c.execute("DELETE FROM plays")
     c.execute("DELETE FROM songs")
-    db.commit()
 
 
 def db_create_conn(db_file: str) -> DB:
     conn = None
     try:
-        conn = sqlite3.connect(db_file)
+        conn = sqlite3.connect(db_file, cached_statements=256)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA mmap_size=268435456")
         return conn
     except Error as e:
         print(e)
@@ -339,28 +465,24 @@ def db_execute(conn: DB, sql: str) -> None:
         print(e)
 
 
-def md5_update_from_file(filename: Union[str, Path], hash: Hash) -> Hash:
+def blake3_file(filename: Union[str, Path]) -> str:
     assert Path(filename).is_file()
-    with open(str(filename), "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash.update(chunk)
-    return hash
+    hash = blake3.blake3(max_threads=blake3.blake3.AUTO)
+    hash.update_mmap(str(filename))
+    return hash.hexdigest()
 
 
-def md5_file(filename: Union[str, Path]) -> str:
-    return str(md5_update_from_file(filename, hashlib.md5()).hexdigest())
+def blake3_dir(directory: Union[str, Path]) -> str:
+    """Hash every file in a directory tree, used to detect changes to the data directory.
 
-
-def md5_update_from_dir(directory: Union[str, Path], hash: Hash) -> Hash:
+    The relative path and digest of each file are folded into the final hash in sorted order.
+    BLAKE3 already hashes each file on multiple threads, so files are hashed one at a time.
+    """
     assert Path(directory).is_dir()
-    for path in sorted(Path(directory).iterdir(), key=lambda p: str(p).lower()):
-        hash.update(path.name.encode())
-        if path.is_file():
-            hash = md5_update_from_file(path, hash)
-        elif path.is_dir():
-            hash = md5_update_from_dir(path, hash)
-    return hash
-
-
-def md5_dir(directory: Union[str, Path]) -> str:
-    return str(md5_update_from_dir(directory, hashlib.md5()).hexdigest())
+    directory = Path(directory)
+    files = sorted((p for p in directory.rglob("*") if p.is_file()), key=lambda p: str(p).lower())
+    hash = blake3.blake3()
+    for path in files:
+        hash.update(path.relative_to(directory).as_posix().encode())
+        hash.update(blake3_file(path).encode())
+    return hash.hexdigest()